@@ -42,7 +42,9 @@ class SoundOrVideoTag:
 # note this does not include image tags, which are handled with HTML.
 AVTag = Union[SoundOrVideoTag, TTSTag]
 
-AV_REF_RE = re.compile(r"\[anki:(play:(.):(\d+))\]")
+# the refs are generated by the backend, so the index is always made up
+# of ASCII digits; restricting the pattern to them keeps matching cheap
+AV_REF_RE = re.compile(r"\[anki:(play:(.):([0-9]+))\]", re.ASCII)
 
 
 def strip_av_refs(text: str) -> str:
@@ -1,20 +1,27 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 import atexit
+import functools
 import os
-import re
+import queue
 import subprocess
 import sys
 import threading
 import time
 import wave
 from abc import ABC, abstractmethod
-from concurrent.futures import Future
-from operator import itemgetter
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Type
 
 import pyaudio
 
+try:
+    # optional; when missing, encoding falls back on the lame binary
+    import lameenc
+except ImportError:
+    lameenc = None
+
 import aqt
 from anki.cards import Card
 from anki.lang import _
@@ -33,6 +40,10 @@ OnDoneCallback = Callable[[], None]
 
 
 class Player(ABC):
+    # the tag types this player may be able to handle; when None,
+    # rank_for_tag() is consulted for every tag type
+    supported_tag_types: Optional[Tuple[Type[AVTag], ...]] = None
+
     @abstractmethod
     def play(self, tag: AVTag, on_done: OnDoneCallback) -> None:
         """Play a file.
@@ -69,6 +80,7 @@ class Player(ABC):
 
 class SoundOrVideoPlayer(Player):  # pylint: disable=abstract-method
     default_rank = 0
+    supported_tag_types = (SoundOrVideoTag,)
 
     def rank_for_tag(self, tag: AVTag) -> Optional[int]:
         if isinstance(tag, SoundOrVideoTag):
@@ -88,21 +100,32 @@ class AVPlayer:
     interrupt_current_audio = True
 
     def __init__(self) -> None:
-        self._enqueued: List[AVTag] = []
+        self._enqueued: Deque[AVTag] = deque()
         self.current_player: Optional[Player] = None
+        # tag type -> players that may be able to handle it
+        self._players_by_tag_type: Dict[type, List[Player]] = {}
+        self._dispatch_snapshot: List[Player] = []
+
+    def register_player(self, player: Player) -> None:
+        "Add a player, updating the tag-type dispatch table."
+        self.players.append(player)
+        self._rebuild_dispatch_table()
 
     def play_tags(self, tags: List[AVTag]) -> None:
-        """Clear the existing queue, then start playing provided tags."""
+        """Clear the existing queue, then start playing provided tags.
+
+        Takes ownership of the tags; callers should not mutate the list
+        after passing it in."""
         self.clear_queue_and_maybe_interrupt()
-        self._enqueued = tags[:]
+        self._enqueued = deque(tags)
         self._play_next_if_idle()
 
     def stop_and_clear_queue(self) -> None:
-        self._enqueued = []
+        self._enqueued.clear()
         self._stop_if_playing()
 
     def clear_queue_and_maybe_interrupt(self) -> None:
-        self._enqueued = []
+        self._enqueued.clear()
         if self.interrupt_current_audio:
             self._stop_if_playing()
 
@@ -110,7 +133,7 @@ class AVPlayer:
         self.play_tags([SoundOrVideoTag(filename=filename)])
 
     def insert_file(self, filename: str) -> None:
-        self._enqueued.insert(0, SoundOrVideoTag(filename=filename))
+        self._enqueued.appendleft(SoundOrVideoTag(filename=filename))
         self._play_next_if_idle()
 
     def toggle_pause(self) -> None:
@@ -133,7 +156,7 @@ class AVPlayer:
     def _pop_next(self) -> Optional[AVTag]:
         if not self._enqueued:
             return None
-        return self._enqueued.pop(0)
+        return self._enqueued.popleft()
 
     def _on_play_finished(self) -> None:
         gui_hooks.av_player_did_end_playing(self.current_player)
@@ -158,18 +181,43 @@ class AVPlayer:
             print("no players found for", tag)
 
     def _best_player_for_tag(self, tag: AVTag) -> Optional[Player]:
-        ranked = []
-        for p in self.players:
+        if self._dispatch_snapshot != self.players:
+            # an add-on has modified .players directly
+            self._rebuild_dispatch_table()
+        candidates = self._players_by_tag_type.get(type(tag))
+        if candidates is None:
+            # no player declared this tag type; ask everyone
+            candidates = self.players
+        best: Optional[Player] = None
+        best_rank: Optional[int] = None
+        for p in candidates:
             rank = p.rank_for_tag(tag)
-            if rank is not None:
-                ranked.append((rank, p))
-
-        ranked.sort(key=itemgetter(0))
-
-        if ranked:
-            return ranked[-1][1]
-        else:
-            return None
+            # as with the previous stable sort, later players win ties
+            if rank is not None and (best_rank is None or rank >= best_rank):
+                best_rank = rank
+                best = p
+        return best
+
+    def _rebuild_dispatch_table(self) -> None:
+        declared_types: set = set()
+        for player in self.players:
+            declared_types.update(getattr(player, "supported_tag_types", None) or ())
+        # players that don't declare their tag types are candidates for
+        # every tag type; candidate lists preserve registration order
+        self._players_by_tag_type = {
+            tag_type: [
+                player
+                for player in self.players
+                if self._may_support_tag_type(player, tag_type)
+            ]
+            for tag_type in declared_types
+        }
+        self._dispatch_snapshot = list(self.players)
+
+    @staticmethod
+    def _may_support_tag_type(player: Player, tag_type: type) -> bool:
+        tag_types = getattr(player, "supported_tag_types", None)
+        return tag_types is None or tag_type in tag_types
 
 
 av_player = AVPlayer()
@@ -177,24 +225,38 @@ av_player = AVPlayer()
 # Packaged commands
 ##########################################################################
 
+# neither the environment nor the bundled executables change at runtime,
+# so the lookups are computed once at module load and cached
+
+if isMac:
+    _moduleDir = os.path.dirname(os.path.abspath(__file__))
+    _exeDir = os.path.abspath(_moduleDir + "/../../Resources/audio")
+else:
+    _exeDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+_baseEnv = os.environ.copy()
+_baseEnv.pop("LD_LIBRARY_PATH", None)
+
+
+@functools.lru_cache(maxsize=None)
+def _packagedExe(exe: str) -> Optional[str]:
+    "Path to a bundled executable, or None if not bundled."
+    path = os.path.join(_exeDir, exe)
+    if os.path.exists(path):
+        return path
+    return None
+
+
 # return modified command array that points to bundled command, and return
 # required environment
 def _packagedCmd(cmd: List[str]) -> Tuple[Any, Dict[str, str]]:
     cmd = cmd[:]
-    env = os.environ.copy()
-    if "LD_LIBRARY_PATH" in env:
-        del env["LD_LIBRARY_PATH"]
-    if isMac:
-        dir = os.path.dirname(os.path.abspath(__file__))
-        exeDir = os.path.abspath(dir + "/../../Resources/audio")
-    else:
-        exeDir = os.path.dirname(os.path.abspath(sys.argv[0]))
-        if isWin and not cmd[0].endswith(".exe"):
-            cmd[0] += ".exe"
-    path = os.path.join(exeDir, cmd[0])
-    if not os.path.exists(path):
-        return cmd, env
-    cmd[0] = path
+    env = _baseEnv.copy()
+    if isWin and not cmd[0].endswith(".exe"):
+        cmd[0] += ".exe"
+    path = _packagedExe(cmd[0])
+    if path is not None:
+        cmd[0] = path
     return cmd, env
 
 
@@ -225,25 +287,37 @@ class SimpleProcessPlayer(Player):  # pylint: disable=abstract-method
 
     def __init__(self, taskman: TaskManager) -> None:
         self._taskman = taskman
-        self._terminate_flag = False
+        # set either when stop() is requested, or when the process exits
+        self._terminate_evt = threading.Event()
         self._process: Optional[subprocess.Popen] = None
+        self._args_tuple: Optional[Tuple[str, ...]] = None
+
+    def _cmd_for_filename(self, filename: str) -> Tuple[str, ...]:
+        # subclasses may still adjust self.args in their __init__, so the
+        # snapshot is deferred until the first play
+        if self._args_tuple is None:
+            self._args_tuple = tuple(self.args)
+        return (*self._args_tuple, filename)
 
     def play(self, tag: AVTag, on_done: OnDoneCallback) -> None:
-        self._terminate_flag = False
+        # a fresh event per play, so a watcher thread left over from a
+        # stopped playback can only set the previous, dead event
+        self._terminate_evt = threading.Event()
         self._taskman.run_in_background(
             lambda: self._play(tag), lambda res: self._on_done(res, on_done)
         )
 
     def stop(self) -> None:
-        self._terminate_flag = True
+        self._terminate_evt.set()
 
     # note: mplayer implementation overrides this
     def _play(self, tag: AVTag) -> None:
         assert isinstance(tag, SoundOrVideoTag)
         self._process = subprocess.Popen(
-            self.args + [tag.filename],
+            self._cmd_for_filename(tag.filename),
             env=self.env,
             startupinfo=startup_info(),
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         )
@@ -254,23 +328,36 @@ class SimpleProcessPlayer(Player):  # pylint: disable=abstract-method
             lambda: gui_hooks.av_player_did_begin_playing(self, tag)
         )
 
-        while True:
-            # should we abort playing?
-            if self._terminate_flag:
-                self._process.terminate()
-                self._process = None
-                return
+        process = self._process
+        terminate_evt = self._terminate_evt
+
+        # subprocess.Popen offers no file descriptor we could portably
+        # select() on together with a stop request, so a watcher thread
+        # blocking in the OS-level wait stands in for one: it sets the
+        # event as soon as the process exits, and stop() sets it on
+        # cancellation, leaving nothing to poll
+        if process.poll() is None:
+
+            def watch() -> None:
+                process.wait()
+                terminate_evt.set()
+
+            threading.Thread(target=watch, daemon=True).start()
+
+            terminate_evt.wait()
 
-            # wait for completion
+        if process.poll() is None:
+            # stop() was requested while the process was still running
+            process.terminate()
             try:
-                self._process.wait(0.1)
-                if self._process.returncode != 0:
-                    print(f"player got return code: {self._process.returncode}")
-                self._process = None
-                return
+                process.wait(2)
             except subprocess.TimeoutExpired:
-                # process still running, repeat loop
-                pass
+                process.kill()
+                process.wait()
+        elif process.returncode != 0:
+            print(f"player got return code: {process.returncode}")
+
+        self._process = None
 
     def _on_done(self, ret: Future, cb: OnDoneCallback) -> None:
         try:
@@ -303,7 +390,8 @@ class SimpleMpvPlayer(SimpleProcessPlayer, SoundOrVideoPlayer):
     def __init__(self, taskman: TaskManager, base_folder: str) -> None:
         super().__init__(taskman)
         conf_path = os.path.join(base_folder, "mpv.conf")
-        self.args += ["--include=" + conf_path]
+        # assign a fresh list, as += would mutate the class attribute
+        self.args = self.args + ["--include=" + conf_path]
 
 
 class SimpleMplayerPlayer(SimpleProcessPlayer, SoundOrVideoPlayer):
@@ -328,7 +416,12 @@ class MpvManager(MPV, SoundOrVideoPlayer):
         self.executable = mpvPath[0]
         self._on_done: Optional[OnDoneCallback] = None
         conf_path = os.path.join(base_path, "mpv.conf")
-        self.default_argv += ["--no-config", "--include=" + conf_path]
+        # assign a fresh list, as += would mutate the class attribute,
+        # extending it again on each instantiation
+        self.default_argv = self.default_argv + [
+            "--no-config",
+            "--include=" + conf_path,
+        ]
         super().__init__(window_id=None, debug=False)
 
     def play(self, tag: AVTag, on_done: OnDoneCallback) -> None:
@@ -374,12 +467,12 @@ class MpvManager(MPV, SoundOrVideoPlayer):
 class SimpleMplayerSlaveModePlayer(SimpleMplayerPlayer):
     def __init__(self, taskman: TaskManager):
         super().__init__(taskman)
-        self.args.append("-slave")
+        self.args = self.args + ["-slave"]
 
     def _play(self, tag: AVTag) -> None:
         assert isinstance(tag, SoundOrVideoTag)
         self._process = subprocess.Popen(
-            self.args + [tag.filename],
+            self._cmd_for_filename(tag.filename),
             env=self.env,
             stdin=subprocess.PIPE,
             stdout=subprocess.DEVNULL,
@@ -421,9 +514,40 @@ processingChain: List[List[str]] = [
 ]
 
 
+# a small shared pool, so encoding doesn't block the UI thread, and
+# multiple recordings can encode in parallel; the work is either a lame
+# subprocess or the C lameenc encoder, so threads suffice
+_encode_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _encode_pool_instance() -> ThreadPoolExecutor:
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ThreadPoolExecutor(
+            max_workers=max(1, (os.cpu_count() or 2) // 2)
+        )
+    return _encode_pool
+
+
 class _Recorder:
     def postprocess(self, encode=True) -> None:
+        self.postprocess_async(encode).result()
+
+    def postprocess_async(self, encode=True) -> Future:
+        """Process the recording on the shared encoding pool.
+
+        Returns a future that completes when the output file is ready."""
         self.encode = encode
+        return _encode_pool_instance().submit(self._postprocess)
+
+    def _postprocess(self) -> None:
+        if self.encode and lameenc is not None:
+            # encode in-process, avoiding a subprocess spawn per recording
+            try:
+                self._encode_mp3()
+            finally:
+                self.cleanup()
+            return
         for c in processingChain:
             # print c
             if not self.encode and c[0] == "lame":
@@ -440,6 +564,20 @@ class _Recorder:
             if ret:
                 raise Exception(_("Error running %s") % " ".join(cmd))
 
+    def _encode_mp3(self) -> None:
+        "Encode the recorded wave file to mp3 with the lameenc binding."
+        wf = wave.open(processingSrc, "rb")
+        frames = wf.readframes(wf.getnframes())
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(128)
+        encoder.set_in_sample_rate(wf.getframerate())
+        encoder.set_channels(wf.getnchannels())
+        encoder.set_quality(3)
+        wf.close()
+        mp3 = encoder.encode(frames) + encoder.flush()
+        with open(processingDst, "wb") as file:
+            file.write(mp3)
+
     def cleanup(self) -> None:
         if os.path.exists(processingSrc):
             os.unlink(processingSrc)
@@ -469,17 +607,37 @@ class PyAudioThreadedRecorder(threading.Thread):
 
         stream.read(wait)
 
-        data = b""
-        while not self.finish:
-            data += stream.read(chunk, exception_on_overflow=False)
-        stream.close()
-        p.terminate()
         wf = wave.open(processingSrc, "wb")
         wf.setnchannels(PYAU_CHANNELS)
         wf.setsampwidth(p.get_sample_size(PYAU_FORMAT))
         wf.setframerate(rate)
-        wf.writeframes(data)
-        wf.close()
+
+        # captured chunks are drained to disk on a separate thread, so
+        # memory use stays constant and the capture loop never blocks
+        # on I/O; None signals the end of the recording
+        frames: queue.SimpleQueue = queue.SimpleQueue()
+
+        def write_frames() -> None:
+            while True:
+                data = frames.get()
+                if data is None:
+                    break
+                wf.writeframesraw(data)
+            wf.close()
+
+        writer = threading.Thread(target=write_frames)
+        writer.start()
+
+        try:
+            while not self.finish:
+                frames.put(stream.read(chunk, exception_on_overflow=False))
+            stream.close()
+            p.terminate()
+        finally:
+            # always queue the sentinel, so a capture error can't leave
+            # the writer blocked forever with the wave file open
+            frames.put(None)
+            writer.join()
 
 
 class PyAudioRecorder(_Recorder):
@@ -489,10 +647,8 @@ class PyAudioRecorder(_Recorder):
 
     def __init__(self) -> None:
         for t in recFiles + [processingSrc, processingDst]:
-            try:
+            if os.path.exists(t):
                 os.unlink(t)
-            except OSError:
-                pass
         self.encode = False
 
     def start(self) -> None:
@@ -535,23 +691,38 @@ def getAudio(parent: QWidget, encode: bool = True) -> Optional[str]:
     t = time.time()
     r.start()
     time.sleep(r.startupDelay)
-    QApplication.instance().processEvents()  # type: ignore
-    while not mb.clickedButton():
-        txt = _("Recording...<br>Time: %0.1f")
-        mb.setText(txt % (time.time() - t))
-        mb.show()
-        QApplication.instance().processEvents()  # type: ignore
+    txt = _("Recording...<br>Time: %0.1f")
+    mb.setText(txt % 0)
+    # update the elapsed time from the event loop, instead of spinning
+    # on processEvents()
+    timer = QTimer(mb)
+    timer.setInterval(100)
+    timer.timeout.connect(lambda: mb.setText(txt % (time.time() - t)))  # type: ignore
+    timer.start()
+    mb.exec_()
+    timer.stop()
     if mb.clickedButton() == mb.escapeButton():
         r.stop()
         r.cleanup()
         return None
     saveGeom(mb, "audioRecorder")
     # ensure at least a second captured
-    while time.time() - t < 1:
-        time.sleep(0.1)
+    remaining = 1 - (time.time() - t)
+    if remaining > 0:
+        time.sleep(remaining)
     r.stop()
-    # process
-    r.postprocess(encode)
+    # process on the encoding pool, keeping the UI responsive while
+    # waiting for the result
+    future = r.postprocess_async(encode)
+    loop = QEventLoop(parent)
+    timer = QTimer(parent)
+    timer.setInterval(50)
+    timer.timeout.connect(lambda: loop.quit() if future.done() else None)  # type: ignore
+    timer.start()
+    loop.exec_()
+    timer.stop()
+    # surface any encoding error to the caller
+    future.result()
     return r.file()
 
 
@@ -577,31 +748,43 @@ _player = play
 _queueEraser = clearAudioQueue
 mpvManager: Optional["MpvManager"] = None
 
-# add everything from this module into anki.sound for backwards compat
-_exports = [i for i in locals().items() if not i[0].startswith("__")]
-for (k, v) in _exports:
-    sys.modules["anki.sound"].__dict__[k] = v
+# add the legacy sound API into anki.sound for backwards compat
+_exports = (
+    "av_player",
+    "play",
+    "playFromText",
+    "clearAudioQueue",
+    "Recorder",
+    "getAudio",
+    "mpvManager",
+    "_player",
+    "_queueEraser",
+)
+_sound_mod = sys.modules["anki.sound"].__dict__
+for _export in _exports:
+    _sound_mod[_export] = globals()[_export]
 
 # Tag handling
 ##########################################################################
 
 
-def av_refs_to_play_icons(text: str) -> str:
-    """Add play icons into the HTML.
-
-    When clicked, the icon will call eg pycmd('play:q:1').
-    """
-
-    def repl(match: re.Match) -> str:
-        return f"""
-<a class="replay-button soundLink" href=# onclick="pycmd('{match.group(1)}'); return false;">
+# substituted via a backreference, so matches are rewritten without a
+# Python callback per match
+_PLAY_ICON_TEMPLATE = r"""
+<a class="replay-button soundLink" href=# onclick="pycmd('\1'); return false;">
     <svg class="playImage" viewBox="0 0 64 64" version="1.1">
         <circle cx="32" cy="32" r="29" />
         <path d="M56.502,32.301l-37.502,20.101l0.329,-40.804l37.173,20.703Z" />
     </svg>
 </a>"""
 
-    return AV_REF_RE.sub(repl, text)
+
+def av_refs_to_play_icons(text: str) -> str:
+    """Add play icons into the HTML.
+
+    When clicked, the icon will call eg pycmd('play:q:1').
+    """
+    return AV_REF_RE.sub(_PLAY_ICON_TEMPLATE, text)
 
 
 def play_clicked_audio(pycmd: str, card: Card) -> None:
@@ -632,20 +815,20 @@ def setup_audio(taskman: TaskManager, base_folder: str) -> None:
             print("mpv too old, reverting to mplayer")
 
     if mpvManager is not None:
-        av_player.players.append(mpvManager)
+        av_player.register_player(mpvManager)
     else:
         mplayer = SimpleMplayerSlaveModePlayer(taskman)
-        av_player.players.append(mplayer)
+        av_player.register_player(mplayer)
 
     # tts support
     if isMac:
         from aqt.tts import MacTTSPlayer
 
-        av_player.players.append(MacTTSPlayer(taskman))
+        av_player.register_player(MacTTSPlayer(taskman))
     elif isWin:
         from aqt.tts import WindowsTTSPlayer
 
-        av_player.players.append(WindowsTTSPlayer(taskman))
+        av_player.register_player(WindowsTTSPlayer(taskman))
 
     # cleanup at shutdown
     atexit.register(av_player.shutdown)
@@ -95,6 +95,10 @@ class TTSPlayer:
 
 
 class TTSProcessPlayer(SimpleProcessPlayer, TTSPlayer):
+    # declared here rather than in TTSPlayer, as Player comes first in
+    # the MRO and would shadow it with the None default
+    supported_tag_types = (TTSTag,)
+
     # mypy gets confused if rank_for_tag is defined in TTSPlayer
     def rank_for_tag(self, tag: AVTag) -> Optional[int]:
         if not isinstance(tag, TTSTag):
@@ -499,12 +503,12 @@ if isWin:
 
                 # wait 100ms
                 while not self.speaker.WaitUntilDone(100):
-                    if self._terminate_flag:
+                    if self._terminate_evt.is_set():
                         # stop playing
                         self.speaker.Skip("Sentence", 2 ** 15)
                         return
             finally:
-                self._terminate_flag = False
+                self._terminate_evt.clear()
 
         def _tidy_name(self, name: str) -> str:
             "eg. Microsoft Haruka Desktop -> Microsoft_Haruka."